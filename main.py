@@ -1,16 +1,30 @@
 import os
 import re
-import json
+import sys
 import base64
+import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+from dataclasses import dataclass
 from email.mime.text import MIMEText
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import islice
+from datetime import datetime, timedelta
 
+import orjson
+import re2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from selectolax.lexbor import LexborHTMLParser
 
 # ============================================================
 # CHARGEMENT DE LA CONFIGURATION
@@ -25,8 +39,8 @@ def load_config():
     """Charge la configuration depuis config.json."""
     config_path = os.path.join(os.path.dirname(__file__), CONFIG_FILE)
     if os.path.exists(config_path):
-        with open(config_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(config_path, "rb") as f:
+            return orjson.loads(f.read())
     # Fallback si pas de fichier config
     return {}
 
@@ -39,13 +53,41 @@ SHEET_NAME = CONFIG.get("sheet_name", "Avis")
 NOTIFICATION_EMAIL = CONFIG.get("notification_email", "")
 DEFAULT_CATEGORY = CONFIG.get("default_category", "Fast-food")
 
+# Filtre de recherche Gmail supplémentaire (optionnel), ex: "from:noreply@exemple.ch"
+GMAIL_QUERY = CONFIG.get("gmail_query", "")
+
 # Configuration retry API
 API_MAX_RETRIES = CONFIG.get("api_retry", {}).get("max_retries", 3)
 API_INITIAL_DELAY = CONFIG.get("api_retry", {}).get("initial_delay_seconds", 1)
+# Attente max acceptée depuis un Retry-After (au-delà : backoff exponentiel)
+API_MAX_RETRY_AFTER = CONFIG.get("api_retry", {}).get("max_retry_after_seconds", 60)
+
+# Taille d'un lot Gmail (limite 100 requêtes par batch, Google recommande 50)
+GMAIL_BATCH_SIZE = 50
+# Nombre de lots exécutés en parallèle : au plus 100 messages.get (5 unités chacun)
+# en vol, pour rester proche du quota Gmail d'environ 250 unités/s par utilisateur
+GMAIL_FETCH_WORKERS = 2
+
+# Les lignes sont écrites dans le Sheet par tranches de cette taille
+SHEET_WRITE_BATCH_SIZE = 500
+
+# Réponse partielle Gmail : uniquement les headers et les parties texte utiles
+# (trois niveaux de parties : mixed → alternative → related → texte)
+GMAIL_MESSAGE_FIELDS = (
+    "id,payload(mimeType,headers(name,value),body/data,"
+    "parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data))))"
+)
 
 # Mapping Nom commerce → Subdomain
 COMMERCE_TO_SUBDOMAIN = CONFIG.get("commerce_to_subdomain", {})
 
+# Même mapping indexé par nom normalisé (minuscules, sans espaces autour) ;
+# en cas de doublon après normalisation, la première entrée l'emporte
+COMMERCE_TO_SUBDOMAIN_LOWER = {
+    commerce.lower().strip(): subdomain
+    for commerce, subdomain in reversed(COMMERCE_TO_SUBDOMAIN.items())
+}
+
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
     "https://www.googleapis.com/auth/spreadsheets",
@@ -66,14 +108,68 @@ GENDER_MAP = {
 # ============================================================
 # FILTRAGE (chargé depuis config.json)
 # ============================================================
-EMAIL_BLACKLIST = set(CONFIG.get("email_blacklist", []))
-SPAM_KEYWORDS = set(CONFIG.get("spam_keywords", []))
-DISPOSABLE_DOMAINS = set(CONFIG.get("disposable_domains", []))
+# Les listes sont des frozensets figés au chargement : les validateurs
+# peuvent donc être mémoïsés sans invalidation.
+def load_filter_set(key):
+    """Charge une liste de filtrage en frozenset (valeurs en minuscules, internées)."""
+    return frozenset(sys.intern(value.lower().strip()) for value in CONFIG.get(key, []))
+
+
+EMAIL_BLACKLIST = load_filter_set("email_blacklist")
+SPAM_KEYWORDS = load_filter_set("spam_keywords")
+DISPOSABLE_DOMAINS = load_filter_set("disposable_domains")
+
+
+def build_domain_trie(domains):
+    """Construit un trie des domaines, labels lus de droite à gauche ("$" = fin de domaine)."""
+    trie = {}
+    for domain in domains:
+        node = trie
+        for label in reversed(domain.lower().split(".")):
+            node = node.setdefault(label, {})
+        node["$"] = True
+    return trie
+
+
+DISPOSABLE_TRIE = build_domain_trie(DISPOSABLE_DOMAINS)
+
+
+def is_disposable_domain(domain):
+    """Vérifie si le domaine (ou un de ses domaines parents) est jetable."""
+    # Correspondance exacte d'abord
+    if domain in DISPOSABLE_DOMAINS:
+        return True
+
+    # Sous-domaines : foo.mailinator.com → mailinator.com
+    node = DISPOSABLE_TRIE
+    for label in reversed(domain.split(".")):
+        node = node.get(label)
+        if node is None:
+            return False
+        if "$" in node:
+            return True
+    return False
 
 
 # ============================================================
 # RETRY AVEC BACKOFF EXPONENTIEL
 # ============================================================
+def get_retry_after(error):
+    """
+    Délai demandé par le serveur via le header Retry-After (en secondes).
+    Retourne None si le header est absent, illisible ou dépasse API_MAX_RETRY_AFTER.
+    """
+    try:
+        wait = float(error.resp.get("retry-after"))
+    except (TypeError, ValueError):
+        # Header absent ou au format date HTTP
+        return None
+    # Délai trop long : ne pas bloquer le job, le backoff prend le relais
+    if wait < 0 or wait > API_MAX_RETRY_AFTER:
+        return None
+    return wait
+
+
 def api_call_with_retry(func, *args, **kwargs):
     """
     Exécute une fonction API avec retry et backoff exponentiel.
@@ -92,8 +188,14 @@ def api_call_with_retry(func, *args, **kwargs):
                 raise
             # 429 (rate limit) ou 5xx = retry
             if attempt < API_MAX_RETRIES - 1:
-                print(f"   ⚠️ Erreur API ({e.resp.status}), nouvelle tentative dans {delay}s...")
-                time.sleep(delay)
+                # Respecter le Retry-After du serveur (+ jitter) s'il est raisonnable, sinon backoff
+                wait = get_retry_after(e)
+                if wait is None:
+                    wait = delay
+                else:
+                    wait += random.uniform(0, 0.25 * wait)
+                print(f"   ⚠️ Erreur API ({e.resp.status}), nouvelle tentative dans {wait:.1f}s...")
+                time.sleep(wait)
                 delay *= 2  # Backoff exponentiel
         except Exception as e:
             last_exception = e
@@ -106,6 +208,7 @@ def api_call_with_retry(func, *args, **kwargs):
     raise last_exception
 
 
+@lru_cache(maxsize=8192)
 def is_valid_email(email):
     """Vérifie si un email est valide (filtrage modéré)."""
     if not email:
@@ -118,38 +221,38 @@ def is_valid_email(email):
         return False
 
     # 2. Format basique
-    if "@" not in email or "." not in email:
+    local_part, at, domain = email.rpartition("@")
+    if not at or "." not in email:
         return False
 
-    local_part, domain = email.rsplit("@", 1)
-
     # 3. Partie locale trop courte (moins de 3 caractères)
     if len(local_part) < 3:
         return False
 
-    # 4. Domaines jetables
-    if domain in DISPOSABLE_DOMAINS:
-        return False
-
-    # 5. Mots-clés spam (correspondance exacte de la partie locale)
+    # 4. Mots-clés spam (correspondance exacte de la partie locale)
     if local_part in SPAM_KEYWORDS:
         return False
 
-    # 6. Que des chiffres dans la partie locale
+    # 5. Que des chiffres dans la partie locale
     if local_part.isdigit():
         return False
 
-    # 7. Répétition excessive (ex: aaaa, 1111)
-    if len(set(local_part)) <= 2 and len(local_part) > 3:
+    # 6. Répétition excessive (ex: aaaa, 1111) — set() seulement au-delà de 3 caractères
+    if len(local_part) > 3 and len(set(local_part)) <= 2:
+        return False
+
+    # 7. Domaines jetables (parcours du trie en dernier, c'est le test le plus coûteux)
+    if is_disposable_domain(domain):
         return False
 
     return True
 
 
 # Noms suspects à filtrer (chargé depuis config.json)
-SUSPICIOUS_NAMES = set(CONFIG.get("suspicious_names", []))
+SUSPICIOUS_NAMES = load_filter_set("suspicious_names")
 
 
+@lru_cache(maxsize=8192)
 def is_valid_name(nom, prenom):
     """Vérifie si le nom/prénom est valide."""
     nom = (nom or "").lower().strip()
@@ -177,9 +280,10 @@ def is_valid_name(nom, prenom):
 
 
 # Commentaires exactement égaux à ces valeurs = invalides (chargé depuis config.json)
-COMMENT_SPAM_EXACT = set(CONFIG.get("comment_spam_exact", []))
+COMMENT_SPAM_EXACT = load_filter_set("comment_spam_exact")
 
 
+@lru_cache(maxsize=8192)
 def is_valid_comment(commentaire):
     """Vérifie si le commentaire est valide."""
     if not commentaire:
@@ -197,13 +301,24 @@ def is_valid_comment(commentaire):
 # ============================================================
 # AUTHENTIFICATION
 # ============================================================
+def save_token(creds):
+    """Écrit le token sur disque, sauf s'il est identique au fichier existant."""
+    new_token = creds.to_json()
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, "r") as token:
+            if token.read() == new_token:
+                return
+    with open(TOKEN_FILE, "w") as token:
+        token.write(new_token)
+
+
 def get_credentials():
     creds = None
 
     # Mode GitHub Actions : lire depuis les variables d'environnement
     if os.environ.get("GOOGLE_TOKEN"):
         print("   (Mode GitHub Actions)")
-        token_data = json.loads(os.environ["GOOGLE_TOKEN"])
+        token_data = orjson.loads(os.environ["GOOGLE_TOKEN"])
         creds = Credentials.from_authorized_user_info(token_data, SCOPES)
     # Mode local : lire depuis le fichier
     elif os.path.exists(TOKEN_FILE):
@@ -214,8 +329,7 @@ def get_credentials():
             creds.refresh(Request())
             # Sauvegarder le token rafraîchi (mode local uniquement)
             if not os.environ.get("GOOGLE_TOKEN") and os.path.exists(TOKEN_FILE):
-                with open(TOKEN_FILE, "w") as token:
-                    token.write(creds.to_json())
+                save_token(creds)
         else:
             # Première authentification (mode local uniquement)
             if os.environ.get("GOOGLE_TOKEN"):
@@ -232,25 +346,56 @@ def get_credentials():
 # ÉTAT (sauvegarde de la progression)
 # ============================================================
 STATE_SHEET_NAME = "_processed_ids"
+STATE_MAX_IDS = 10000           # IDs conservés lors d'une compaction
+STATE_COMPACT_THRESHOLD = 15000  # Taille à partir de laquelle on compacte
+
+# Propriétés des feuilles du classeur (titre → properties), chargées une seule fois
+SHEET_PROPERTIES = None
+
+
+def get_sheet_properties(sheets_service):
+    """Retourne les propriétés des feuilles (un seul spreadsheets.get par exécution)."""
+    global SHEET_PROPERTIES
+    if SHEET_PROPERTIES is None:
+        spreadsheet = api_call_with_retry(
+            sheets_service.spreadsheets().get(
+                spreadsheetId=SPREADSHEET_ID,
+                fields="sheets.properties",
+            ).execute
+        )
+        SHEET_PROPERTIES = {
+            s["properties"]["title"]: s["properties"]
+            for s in spreadsheet.get("sheets", [])
+        }
+    return SHEET_PROPERTIES
 
 
 def load_state(sheets_service=None):
     # Mode local : fichier JSON
     if not os.environ.get("GOOGLE_TOKEN"):
         if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r") as f:
-                return json.load(f)
+            with open(STATE_FILE, "rb") as f:
+                return orjson.loads(f.read())
         return {"processed_ids": []}
 
     # Mode GitHub Actions : lire depuis Google Sheets
     if sheets_service:
         try:
+            # Colonne A = IDs traités, B1 = date de la dernière exécution,
+            # colonne C = emails déjà écrits dans le Sheet (dédoublonnage),
+            # colonne D = IDs en erreur à retenter
             result = sheets_service.spreadsheets().values().get(
                 spreadsheetId=SPREADSHEET_ID,
-                range=f"{STATE_SHEET_NAME}!A:A",
+                range=f"{STATE_SHEET_NAME}!A:D",
             ).execute()
-            ids = [row[0] for row in result.get("values", []) if row]
-            return {"processed_ids": ids}
+            values = result.get("values", [])
+            ids = [row[0] for row in values if row and row[0]]
+            emails = [row[2] for row in values if len(row) > 2 and row[2]]
+            failed = [row[3] for row in values if len(row) > 3 and row[3]]
+            state = {"processed_ids": ids, "processed_emails": emails, "failed_ids": failed}
+            if values and len(values[0]) > 1:
+                state["last_run"] = values[0][1]
+            return state
         except Exception:
             # La feuille n'existe pas encore
             return {"processed_ids": []}
@@ -258,28 +403,27 @@ def load_state(sheets_service=None):
     return {"processed_ids": []}
 
 
-def save_state(state, sheets_service=None):
+def save_state(state, sheets_service=None, new_ids=None, new_emails=None, stored_count=0, final=True):
+    """
+    Enregistre l'état. En mode Sheets, seuls les IDs et emails nouveaux sont ajoutés ;
+    la date de dernière exécution et les IDs en erreur ne sont écrits qu'à la
+    sauvegarde finale (final=True).
+    Retourne le nombre d'IDs désormais stockés, ou None si la sauvegarde a échoué.
+    """
     # Mode local : fichier JSON
     if not os.environ.get("GOOGLE_TOKEN"):
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f, indent=2)
-        return
+        with open(STATE_FILE, "wb") as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+        return len(state.get("processed_ids", []))
 
     # Mode GitHub Actions : sauvegarder dans Google Sheets
     if sheets_service:
         try:
             # Vérifier si la feuille existe, sinon la créer
-            spreadsheet = sheets_service.spreadsheets().get(
-                spreadsheetId=SPREADSHEET_ID
-            ).execute()
-
-            sheet_exists = any(
-                s["properties"]["title"] == STATE_SHEET_NAME
-                for s in spreadsheet.get("sheets", [])
-            )
+            sheet_properties = get_sheet_properties(sheets_service)
 
-            if not sheet_exists:
-                sheets_service.spreadsheets().batchUpdate(
+            if STATE_SHEET_NAME not in sheet_properties:
+                response = sheets_service.spreadsheets().batchUpdate(
                     spreadsheetId=SPREADSHEET_ID,
                     body={
                         "requests": [{
@@ -292,17 +436,18 @@ def save_state(state, sheets_service=None):
                         }]
                     }
                 ).execute()
+                # Mettre à jour le cache localement
+                sheet_properties[STATE_SHEET_NAME] = response["replies"][0]["addSheet"]["properties"]
 
-            # Effacer et réécrire les IDs (garder les 10000 derniers)
-            ids = state.get("processed_ids", [])[-10000:]
-            if ids:
-                # Effacer l'ancienne donnée
+            # stored_count = IDs présents dans la feuille, ajouts de cette exécution compris
+            ids = state.get("processed_ids", [])
+            if stored_count > STATE_COMPACT_THRESHOLD:
+                # Compaction : effacer et réécrire les STATE_MAX_IDS derniers IDs
                 sheets_service.spreadsheets().values().clear(
                     spreadsheetId=SPREADSHEET_ID,
                     range=f"{STATE_SHEET_NAME}!A:A",
                 ).execute()
 
-                # Écrire les nouveaux IDs
                 values = [[id_] for id_ in ids]
                 sheets_service.spreadsheets().values().update(
                     spreadsheetId=SPREADSHEET_ID,
@@ -310,10 +455,56 @@ def save_state(state, sheets_service=None):
                     valueInputOption="RAW",
                     body={"values": values},
                 ).execute()
+                stored_count = len(ids)
+            elif new_ids:
+                # Ajouter uniquement les IDs traités depuis la dernière sauvegarde
+                sheets_service.spreadsheets().values().append(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{STATE_SHEET_NAME}!A:A",
+                    valueInputOption="RAW",
+                    body={"values": [[id_] for id_ in new_ids]},
+                ).execute()
+
+            if new_emails:
+                # Ajouter uniquement les emails écrits depuis la dernière sauvegarde
+                sheets_service.spreadsheets().values().append(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{STATE_SHEET_NAME}!C:C",
+                    valueInputOption="RAW",
+                    body={"values": [[email] for email in new_emails]},
+                ).execute()
+
+            # Date de la dernière exécution (sert de filtre à la prochaine liste)
+            if final and state.get("last_run"):
+                sheets_service.spreadsheets().values().update(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{STATE_SHEET_NAME}!B1",
+                    valueInputOption="RAW",
+                    body={"values": [[state["last_run"]]]},
+                ).execute()
+
+            # IDs en erreur : remplacent la liste précédente (retentés à la prochaine exécution)
+            if final:
+                sheets_service.spreadsheets().values().clear(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{STATE_SHEET_NAME}!D:D",
+                ).execute()
+                failed = state.get("failed_ids", [])
+                if failed:
+                    sheets_service.spreadsheets().values().update(
+                        spreadsheetId=SPREADSHEET_ID,
+                        range=f"{STATE_SHEET_NAME}!D1",
+                        valueInputOption="RAW",
+                        body={"values": [[id_] for id_ in failed]},
+                    ).execute()
+
+            return stored_count
 
         except Exception as e:
             print(f"   ⚠️ Erreur sauvegarde état: {e}")
 
+    return None
+
 
 def load_existing_emails(sheets_service):
     """Charge les emails déjà présents dans le Sheet pour éviter les doublons."""
@@ -336,17 +527,25 @@ def load_existing_emails(sheets_service):
 # ============================================================
 # EXTRACTION DU NOM DE COMMERCE (depuis le header From)
 # ============================================================
-def get_sender_name(message):
+def index_headers(message):
+    """Indexe les headers du mail par nom (minuscule), en gardant la première occurrence."""
     headers = message.get("payload", {}).get("headers", [])
-    for header in headers:
-        if header["name"].lower() == "from":
-            from_value = header["value"]
-            # Format: "Burger King Thal <noreply@mail.carrd.site>"
-            match = re.match(r'"?([^"<]+)"?\s*<', from_value)
-            if match:
-                return match.group(1).strip()
-            return from_value
-    return ""
+    return {header["name"].lower(): header["value"] for header in reversed(headers)}
+
+
+# Nom d'affichage de l'expéditeur, ex: "Burger King Thal" <noreply@mail.carrd.site>
+SENDER_PATTERN = re.compile(r'"?([^"<]+)"?\s*<')
+
+
+def get_sender_name(headers):
+    from_value = headers.get("from")
+    if from_value is None:
+        return ""
+    # Format: "Burger King Thal <noreply@mail.carrd.site>"
+    match = SENDER_PATTERN.match(from_value)
+    if match:
+        return match.group(1).strip()
+    return from_value
 
 
 def convert_commerce_to_subdomain(nom_commerce):
@@ -356,188 +555,357 @@ def convert_commerce_to_subdomain(nom_commerce):
         return COMMERCE_TO_SUBDOMAIN[nom_commerce]
 
     # Recherche insensible à la casse
-    nom_lower = nom_commerce.lower().strip()
-    for commerce, subdomain in COMMERCE_TO_SUBDOMAIN.items():
-        if commerce.lower().strip() == nom_lower:
-            return subdomain
+    subdomain = COMMERCE_TO_SUBDOMAIN_LOWER.get(nom_commerce.lower().strip())
+    if subdomain is not None:
+        return subdomain
 
     # Pas de correspondance trouvée, retourner le nom original
     return nom_commerce
 
 
-def get_email_date(message):
+def get_email_date(headers):
     """Extrait la date de réception de l'email et la formate en DD/MM/YYYY."""
-    headers = message.get("payload", {}).get("headers", [])
-    for header in headers:
-        if header["name"].lower() == "date":
-            date_str = header["value"]
-            # Format typique: "Thu, 6 Feb 2025 10:30:00 +0100"
-            try:
-                from email.utils import parsedate_to_datetime
-                dt = parsedate_to_datetime(date_str)
-                return dt.strftime("%d/%m/%Y")
-            except Exception:
-                # Fallback: retourner la date brute tronquée
-                return date_str[:16] if date_str else ""
-    return ""
+    date_str = headers.get("date")
+    if date_str is None:
+        return ""
+    # Format typique: "Thu, 6 Feb 2025 10:30:00 +0100"
+    try:
+        dt = parsedate_to_datetime(date_str)
+        return dt.strftime("%d/%m/%Y")
+    except Exception:
+        # Fallback: retourner la date brute tronquée
+        return date_str[:16] if date_str else ""
 
 
 # ============================================================
 # EXTRACTION DES DONNÉES D'UN MAIL
 # ============================================================
+# Patterns compilés une seule fois avec RE2 (automate, temps linéaire garanti
+# même sur un corps de mail malformé). Flags en ligne : (?i) casse, (?s) DOTALL.
+# \s de RE2 ne couvre que l'ASCII : ces classes reprennent les espaces Unicode
+# du \s de Python (espace insécable U+00A0, U+2003, \v...)
+SPACE = r"[\s\p{Z}\v\x1c-\x1f\x85]"
+NON_SPACE = r"[^\s\p{Z}\v\x1c-\x1f\x85]"
+# Adresse bornée par classes de caractères, précédée d'un ", ' ou < optionnel.
+# Partie locale : caractères "atext" de la RFC 5322 (ex: jean.o'brien@gmail.com),
+# lettres et chiffres Unicode (\pL, \pN) pour les adresses internationalisées
+# (ex: anna.müller@gmail.com) ; dernier label alphanumérique pour les TLD punycode
+# (ex: .xn--p1ai). Le filtrage fin reste fait par is_valid_email.
+EMAIL_REGEX = (
+    rf"Pour r[ée]pondre:{SPACE}*[\"'<]?"
+    r"(?P<email>[\pL\pN.!#$%&'*+/=?^_`{|}~-]+@[\pL\pN.-]+\.[\pL\pN-]{2,})"
+)
+EMAIL_PATTERN = re2.compile(f"(?i){EMAIL_REGEX}")
+# Intro en tête du mail : [Genre] Nom [Prénom] vient de vous suggérer ceci à ...:
+# Les groupes optionnels reproduisent la cascade (du plus complet au plus simple)
+INTRO_REGEX = (
+    rf"\A{SPACE}*(?:(?P<genre>Monsieur|Madame|Herr|Frau|Signor|Signora|Mx){SPACE}+)?"
+    rf"(?P<nom>{NON_SPACE}+)(?:{SPACE}+(?P<prenom>[^\n]+?))?"
+    rf"{SPACE}+vient de vous sugg[ée]rer ceci [àa]{SPACE}*[^:]*:{SPACE}*"
+)
+# Intro et email en une seule passe (finditer)
+BODY_PATTERN = re2.compile(f"(?is){INTRO_REGEX}|{EMAIL_REGEX}")
+# Préfiltre littéral : sans "Pour répondre:" / "Pour repondre:", inutile de lancer les regex
+REPLY_MARKERS = ("pour répondre:", "pour repondre:")
+
+
+@dataclass(slots=True)
+class ParsedEmail:
+    """Champs extraits du corps d'un mail."""
+    genre: str = ""
+    nom: str = ""
+    prenom: str = ""
+    email: str = ""
+    commentaire: str = ""
+
+
+def clean_comment(text):
+    """Normalise les fins de ligne du commentaire (CRLF / CR → LF)."""
+    return text.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
 def parse_email_body(body_text):
     """
     Parse le corps d'un email avec parsing en cascade.
-    Retourne None si aucun email n'est trouvé (champ obligatoire).
+    Retourne un ParsedEmail, ou None si aucun email n'est trouvé (champ obligatoire).
     """
-    result = {
-        "genre": "",
-        "nom": "",
-        "prenom": "",
-        "email": "",
-        "commentaire": "",
-    }
+    # Mail sans marqueur de réponse (pub, notification...) : rejet immédiat
+    body_lower = body_text.lower()
+    if not any(marker in body_lower for marker in REPLY_MARKERS):
+        return None
 
-    # Nettoyage du texte
-    body_text = body_text.replace("\r\n", "\n").replace("\r", "\n").strip()
+    result = ParsedEmail()
 
-    # ÉTAPE 1: Extraire l'email (OBLIGATOIRE)
-    email_pattern = r"Pour r[ée]pondre:\s*(\S+@\S+)"
-    email_match = re.search(email_pattern, body_text, re.IGNORECASE)
+    # ÉTAPE 1: Intro (en tête) + email (OBLIGATOIRE) en une seule passe
+    intro_match = email_match = None
+    for match in BODY_PATTERN.finditer(body_text):
+        if match.group("email") is None:
+            intro_match = match
+            continue
+        email_match = match
+        break
+
+    if not email_match and intro_match:
+        # L'intro a englobé "Pour répondre" : chercher l'email sans elle
+        intro_match = None
+        email_match = EMAIL_PATTERN.search(body_text)
 
     if not email_match:
         # Pas d'email = entrée invalide
         return None
 
-    result["email"] = email_match.group(1).strip()
+    result.email = email_match.group("email")
 
-    # Texte avant "Pour répondre" (contient intro + commentaire)
-    text_before_email = body_text[:email_match.start()].strip()
+    # ÉTAPE 2: Champs selon les groupes présents (Genre et Prénom optionnels)
+    if intro_match:
+        genre_raw = intro_match.group("genre")
+        if genre_raw:
+            result.genre = GENDER_MAP.get(genre_raw.lower(), "Autre")
+        result.nom = intro_match.group("nom").strip()
+        result.prenom = (intro_match.group("prenom") or "").strip()
+        result.commentaire = clean_comment(body_text[intro_match.end():email_match.start()])
+        return result
 
-    # ÉTAPE 2: Parsing en cascade (du plus complet au plus simple)
+    # Aucun pattern reconnu, mais on a l'email → garder avec marqueur
+    text_before_email = body_text[:email_match.start()]
+    result.commentaire = f"[FORMAT NON RECONNU] {clean_comment(text_before_email)[:500]}"
+    return result
 
-    # Pattern 1: Format complet - Genre Nom Prénom
-    pattern1 = r"^(Monsieur|Madame|Herr|Frau|Signor|Signora|Mx)\s+(\S+)\s+(.+?)\s+vient de vous sugg[ée]rer ceci [àa]\s*.+?:\s*"
-    match = re.match(pattern1, text_before_email, re.IGNORECASE | re.DOTALL)
 
-    if match:
-        genre_raw = match.group(1).strip().lower()
-        result["genre"] = GENDER_MAP.get(genre_raw, "Autre")
-        result["nom"] = match.group(2).strip()
-        result["prenom"] = match.group(3).strip()
-        result["commentaire"] = text_before_email[match.end():].strip()
-        return result
+def find_part(payload, mime_type):
+    """
+    Parcours en profondeur (itératif) de l'arbre MIME, dans l'ordre du mail.
+    Retourne la première partie du type demandé ayant un contenu, sinon None.
+    """
+    stack = deque([payload])
+    while stack:
+        part = stack.pop()
+        if part.get("mimeType") == mime_type and part.get("body", {}).get("data"):
+            return part
+        # Enfants empilés à l'envers pour dépiler le premier en premier
+        stack.extend(reversed(part.get("parts", [])))
+    return None
 
-    # Pattern 2: Genre Nom (sans prénom)
-    pattern2 = r"^(Monsieur|Madame|Herr|Frau|Signor|Signora|Mx)\s+(\S+)\s+vient de vous sugg[ée]rer ceci [àa]\s*.+?:\s*"
-    match = re.match(pattern2, text_before_email, re.IGNORECASE | re.DOTALL)
 
-    if match:
-        genre_raw = match.group(1).strip().lower()
-        result["genre"] = GENDER_MAP.get(genre_raw, "Autre")
-        result["nom"] = match.group(2).strip()
-        result["commentaire"] = text_before_email[match.end():].strip()
-        return result
+def decode_part_text(part):
+    """Décode le contenu base64url d'une partie MIME en texte (un seul décodage)."""
+    return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", "replace")
 
-    # Pattern 3: Nom Prénom (sans genre)
-    pattern3 = r"^(\S+)\s+(.+?)\s+vient de vous sugg[ée]rer ceci [àa]\s*.+?:\s*"
-    match = re.match(pattern3, text_before_email, re.IGNORECASE | re.DOTALL)
 
-    if match:
-        result["nom"] = match.group(1).strip()
-        result["prenom"] = match.group(2).strip()
-        result["commentaire"] = text_before_email[match.end():].strip()
-        return result
+def get_email_body(message):
+    payload = message.get("payload", {})
 
-    # Pattern 4: Juste Nom (minimal)
-    pattern4 = r"^(\S+)\s+vient de vous sugg[ée]rer ceci [àa]\s*.+?:\s*"
-    match = re.match(pattern4, text_before_email, re.IGNORECASE | re.DOTALL)
+    # text/plain en priorité : on s'arrête à la première trouvée
+    part = find_part(payload, "text/plain")
+    if part is not None:
+        return decode_part_text(part)
 
-    if match:
-        result["nom"] = match.group(1).strip()
-        result["commentaire"] = text_before_email[match.end():].strip()
-        return result
+    # Sinon fallback text/html
+    part = find_part(payload, "text/html")
+    if part is None:
+        return ""
+    html = decode_part_text(part)
+    # Suppression des balises (entités décodées par le parseur) + normalisation des espaces
+    return " ".join(LexborHTMLParser(html).text(separator=" ").split())
 
-    # Aucun pattern reconnu, mais on a l'email → garder avec marqueur
-    result["commentaire"] = f"[FORMAT NON RECONNU] {text_before_email[:500]}"
-    return result
 
+# ============================================================
+# FILTRAGE ET CONSTRUCTION DES LIGNES
+# ============================================================
+def build_row(parsed, nom_commerce, date_reception, seen_emails, stats):
+    """
+    Applique tous les filtres à un mail parsé et retourne la ligne à écrire,
+    ou None si le mail est écarté (le motif est compté dans stats).
+    """
+    # Si pas d'email trouvé (champ obligatoire), ignorer
+    if parsed is None:
+        stats["no_email"] += 1
+        return None
 
-def get_email_body(message):
-    payload = message.get("payload", {})
+    # Normaliser l'email une seule fois : clé de dédoublonnage et valeur écrite
+    parsed.email = parsed.email.lower()
+
+    # Filtrer les emails invalides
+    if not is_valid_email(parsed.email):
+        stats["invalid_email"] += 1
+        return None
 
-    # Cas simple : corps directement dans le payload
-    if "body" in payload and payload["body"].get("data"):
-        return base64.urlsafe_b64decode(payload["body"]["data"]).decode("utf-8", errors="replace")
+    # Dédoublonnage par email
+    if parsed.email in seen_emails:
+        stats["duplicate"] += 1
+        return None
+    seen_emails.add(parsed.email)
 
-    # Cas multipart
-    parts = payload.get("parts", [])
-    for part in parts:
-        if part.get("mimeType") == "text/plain" and part.get("body", {}).get("data"):
-            return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="replace")
-        if part.get("parts"):
-            for sub_part in part["parts"]:
-                if sub_part.get("mimeType") == "text/plain" and sub_part.get("body", {}).get("data"):
-                    return base64.urlsafe_b64decode(sub_part["body"]["data"]).decode("utf-8", errors="replace")
+    # Filtrer les noms suspects
+    if not is_valid_name(parsed.nom, parsed.prenom):
+        stats["invalid_name"] += 1
+        return None
 
-    # Fallback : text/html
-    for part in parts:
-        if part.get("mimeType") == "text/html" and part.get("body", {}).get("data"):
-            html = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="replace")
-            clean = re.sub(r"<[^>]+>", " ", html)
-            clean = re.sub(r"\s+", " ", clean).strip()
-            return clean
+    # Filtrer les commentaires suspects
+    if not is_valid_comment(parsed.commentaire):
+        stats["invalid_comment"] += 1
+        return None
 
-    return ""
+    # Colonnes : ID | Nom commerce (→ subdomain) | Catégorie | Genre | Nom | Prénom | Nom complet | Email | Statut Email | Note | Date | Commentaire
+    # Note: ID (colonne A) est généré automatiquement par =ROW(), on écrit à partir de B
+    subdomain = convert_commerce_to_subdomain(nom_commerce)
+    return [
+        subdomain,              # B: Subdomain (converti depuis Nom commerce)
+        DEFAULT_CATEGORY,       # C: Catégorie
+        parsed.genre,           # D: Genre
+        parsed.nom,             # E: Nom
+        parsed.prenom,          # F: Prénom
+        "",                     # G: Nom complet (vide)
+        parsed.email,           # H: Email
+        "Pending",              # I: Statut Email
+        1,                      # J: Note
+        date_reception,         # K: Date de réception
+        parsed.commentaire,     # L: Commentaire
+    ]
 
 
 # ============================================================
-# EXPANSION AUTOMATIQUE DU GOOGLE SHEET
+# RÉCUPÉRATION DES MAILS PAR LOTS
 # ============================================================
-def ensure_sheet_has_enough_rows(sheets_service, spreadsheet_id, sheet_name, required_rows):
-    """Agrandit la feuille si elle n'a pas assez de lignes."""
-    # Récupérer les métadonnées de la feuille
-    spreadsheet = api_call_with_retry(
-        sheets_service.spreadsheets().get(
-            spreadsheetId=spreadsheet_id
-        ).execute
-    )
+def is_retryable_error(error):
+    """Erreur temporaire : 429 (rate limit) ou 5xx."""
+    return isinstance(error, HttpError) and (error.resp.status == 429 or error.resp.status >= 500)
+
+
+# Connexion HTTP propre à chaque thread de récupération (httplib2 n'est pas thread-safe)
+FETCH_THREAD_STATE = threading.local()
+
 
-    # Trouver la feuille par son nom
-    sheet_id = None
-    current_rows = 0
-    for sheet in spreadsheet.get("sheets", []):
-        if sheet["properties"]["title"] == sheet_name:
-            sheet_id = sheet["properties"]["sheetId"]
-            current_rows = sheet["properties"]["gridProperties"]["rowCount"]
+def get_thread_http(credentials):
+    """
+    Connexion du thread courant, créée au premier lot puis réutilisée (keep-alive).
+    build_http() applique le timeout par défaut de l'API (une socket bloquée ne fige pas le thread).
+    """
+    http = getattr(FETCH_THREAD_STATE, "http", None)
+    if http is None:
+        http = AuthorizedHttp(credentials, http=build_http())
+        FETCH_THREAD_STATE.http = http
+    return http
+
+
+def execute_batch(gmail_service, credentials, message_ids):
+    """
+    Exécute un lot dans un thread, sur la connexion de ce thread.
+    Les sous-requêtes en erreur temporaire sont relancées dans un nouveau lot avec backoff.
+    Retourne la liste des (msg_id, message, exception).
+    """
+    http = get_thread_http(credentials)
+    results = {}
+
+    def on_response(msg_id, response, exception):
+        results[msg_id] = (msg_id, response, exception)
+
+    pending = message_ids
+    delay = API_INITIAL_DELAY
+    for attempt in range(API_MAX_RETRIES):
+        batch = gmail_service.new_batch_http_request(callback=on_response)
+        for msg_id in pending:
+            batch.add(
+                gmail_service.users().messages().get(
+                    userId="me",
+                    id=msg_id,
+                    format="full",
+                    fields=GMAIL_MESSAGE_FIELDS,
+                ),
+                request_id=msg_id,
+            )
+        api_call_with_retry(batch.execute, http=http)
+
+        pending = [msg_id for msg_id in pending if is_retryable_error(results[msg_id][2])]
+        if not pending or attempt == API_MAX_RETRIES - 1:
             break
+        # Respecter le plus long Retry-After des sous-réponses (+ jitter), sinon backoff
+        retry_afters = [get_retry_after(results[msg_id][2]) for msg_id in pending]
+        retry_afters = [wait for wait in retry_afters if wait is not None]
+        if retry_afters:
+            wait = max(retry_afters)
+            wait += random.uniform(0, 0.25 * wait)
+        else:
+            wait = delay
+        print(f"   ⚠️ {len(pending)} mail(s) en erreur temporaire, nouvelle tentative dans {wait:.1f}s...")
+        time.sleep(wait)
+        delay *= 2
+
+    return [results[msg_id] for msg_id in message_ids]
 
-    if sheet_id is None:
-        raise Exception(f"Feuille '{sheet_name}' non trouvée")
 
-    # Ajouter des lignes si nécessaire (avec marge de 1000)
-    if required_rows > current_rows:
-        rows_to_add = required_rows - current_rows + 1000
-        print(f"   📈 Expansion de la feuille : {current_rows} → {current_rows + rows_to_add} lignes")
+def fetch_messages(gmail_service, credentials, message_ids):
+    """
+    Récupère les mails par lots de GMAIL_BATCH_SIZE via BatchHttpRequest.
+    Chaque lot part en une seule requête HTTP et au plus GMAIL_FETCH_WORKERS lots sont
+    en cours : le lot suivant n'est lancé que lorsqu'un lot est rendu. Génère
+    (msg_id, message, exception) au fil des lots terminés, ce qui permet de traiter
+    un lot pendant que les suivants sont téléchargés.
+    """
+    total = len(message_ids)
+    done = 0
+    chunks = (message_ids[start:start + GMAIL_BATCH_SIZE] for start in range(0, total, GMAIL_BATCH_SIZE))
+
+    executor = ThreadPoolExecutor(max_workers=GMAIL_FETCH_WORKERS)
+    futures = {}
+    try:
+        for chunk in islice(chunks, GMAIL_FETCH_WORKERS):
+            futures[executor.submit(execute_batch, gmail_service, credentials, chunk)] = chunk
+
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # Retirer le future : son résultat (le lot de mails) peut être libéré une fois traité
+                chunk = futures.pop(future)
+
+                # Lancer le lot suivant avant de rendre celui-ci
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    futures[executor.submit(execute_batch, gmail_service, credentials, next_chunk)] = next_chunk
+
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # Lot entier en échec : chaque mail est signalé en erreur
+                    results = [(msg_id, None, e) for msg_id in chunk]
+                yield from results
+                done += len(chunk)
+                print(f"   ⏳ {done}/{total} mails traités...")
+    finally:
+        # Arrêt anticipé (erreur côté traitement) : ne pas télécharger les lots restants
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
-        request = {
-            "requests": [{
-                "appendDimension": {
+# ============================================================
+# ÉCRITURE DANS LE GOOGLE SHEET
+# ============================================================
+def to_cell(value):
+    """Cellule brute (équivalent RAW) : nombre ou texte, sans interprétation."""
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": value}}
+
+
+def append_rows(sheets_service, rows):
+    """
+    Ajoute les lignes à la suite du tableau en un seul appel (appendCells) :
+    formule =ROW() en colonne A, valeurs brutes de B à L.
+    appendCells agrandit la feuille si nécessaire.
+    """
+    sheet_id = get_sheet_properties(sheets_service)[SHEET_NAME]["sheetId"]
+    id_cell = {"userEnteredValue": {"formulaValue": "=ROW()"}}
+    api_call_with_retry(
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=SPREADSHEET_ID,
+            body={"requests": [{
+                "appendCells": {
                     "sheetId": sheet_id,
-                    "dimension": "ROWS",
-                    "length": rows_to_add
+                    "rows": [{"values": [id_cell] + [to_cell(v) for v in row]} for row in rows],
+                    "fields": "userEnteredValue",
                 }
-            }]
-        }
-        api_call_with_retry(
-            sheets_service.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id,
-                body=request
-            ).execute
-        )
-        print(f"   ✅ Feuille agrandie")
-
-    return current_rows
+            }]},
+        ).execute
+    )
 
 
 # ============================================================
@@ -557,11 +925,25 @@ def main():
 
     # Charger l'état
     state = load_state(sheets_service)
-    processed_ids = set(state.get("processed_ids", []))
+    loaded_ids = state.get("processed_ids", [])
+    processed_ids = set(loaded_ids)  # Test d'appartenance
+    recent_ids = deque(loaded_ids, maxlen=STATE_MAX_IDS)  # Derniers IDs, dans l'ordre de traitement
     print(f"📋 Mails déjà traités : {len(processed_ids)}")
 
-    # Récupérer tous les messages de la boîte de réception
-    all_messages = []
+    # Ne lister que les mails reçus depuis la dernière exécution (marge d'un jour,
+    # les mails déjà traités dans la marge sont écartés via processed_ids)
+    query_terms = []
+    if state.get("last_run"):
+        since = datetime.fromisoformat(state["last_run"]) - timedelta(days=1)
+        query_terms.append(f"after:{int(since.timestamp())}")
+    if GMAIL_QUERY:
+        query_terms.append(GMAIL_QUERY)
+    query = " ".join(query_terms) or None
+
+    # Récupérer les nouveaux messages de la boîte de réception
+    # (dict id → None : dédoublonne les pages qui se chevauchent en gardant l'ordre)
+    new_messages = {}
+    total_listed = 0
     next_page_token = None
 
     print("📥 Récupération de la liste des mails...")
@@ -572,37 +954,62 @@ def main():
                 labelIds=["INBOX"],
                 maxResults=500,
                 pageToken=next_page_token,
+                q=query,
+                fields="messages/id,nextPageToken",
             ).execute
         )
 
         messages = results.get("messages", [])
-        all_messages.extend(messages)
+        total_listed += len(messages)
         next_page_token = results.get("nextPageToken")
 
-        print(f"   → {len(all_messages)} mails trouvés...")
+        # Filtrer les mails déjà traités
+        page_new = [m["id"] for m in messages if m["id"] not in processed_ids]
+        new_messages.update(dict.fromkeys(page_new))
+
+        print(f"   → {total_listed} mails trouvés...")
 
+        # Pas d'arrêt sur une page entièrement traitée : après une exécution
+        # interrompue, des mails plus anciens peuvent rester à traiter.
+        # Le filtre after: borne déjà la liste aux mails récents.
         if not next_page_token:
             break
 
-    print(f"\n📊 Total : {len(all_messages)} mails dans la boîte de réception")
+    # Mails en erreur lors d'une exécution précédente : retentés même s'ils sont
+    # plus anciens que le filtre after:
+    retried = [id_ for id_ in state.get("failed_ids", []) if id_ not in processed_ids]
+    new_messages.update(dict.fromkeys(retried))
 
-    # Filtrer les mails déjà traités
-    new_messages = [m for m in all_messages if m["id"] not in processed_ids]
+    print(f"\n📊 Total : {total_listed} mails listés dans la boîte de réception")
+    if retried:
+        print(f"🔁 Mails en erreur à retenter : {len(retried)}")
     print(f"🆕 Nouveaux mails à traiter : {len(new_messages)}\n")
 
     if not new_messages:
         print("✅ Aucun nouveau mail. Fin.")
         return
 
-    # Charger les emails déjà dans le Sheet pour dédoublonnage complet
-    print("📋 Chargement des emails existants pour dédoublonnage...")
-    existing_emails = load_existing_emails(sheets_service)
-    print(f"   → {len(existing_emails)} emails déjà dans le Sheet")
+    # Emails déjà dans le Sheet pour dédoublonnage complet : mémorisés dans l'état,
+    # sinon (premier passage) lus depuis le Sheet puis enregistrés dans l'état
+    stored_emails = state.get("processed_emails", [])  # Emails enregistrés dans l'état
+    unsaved_emails = []  # Emails écrits dans le Sheet, pas encore enregistrés dans l'état
+    seen_emails = set(stored_emails)  # Complété au fil du traitement (mails écartés compris)
+    if seen_emails:
+        print(f"📋 {len(seen_emails)} emails connus pour dédoublonnage")
+    else:
+        print("📋 Chargement des emails existants pour dédoublonnage...")
+        seen_emails = load_existing_emails(sheets_service)
+        unsaved_emails.extend(seen_emails)
+        print(f"   → {len(seen_emails)} emails déjà dans le Sheet")
 
     # Traiter chaque nouveau mail
-    rows_to_add = []
+    rows_to_add = []  # Tampon des lignes pas encore écrites
+    row_emails = []  # Emails des lignes du tampon
+    unsaved_ids = []  # IDs traités, pas encore enregistrés dans l'état
+    failed_ids = []  # IDs en erreur, retentés à la prochaine exécution
+    stored_count = len(loaded_ids)  # IDs présents dans l'état
+    rows_added = 0
     errors = []
-    seen_emails = set(existing_emails)  # Inclure les emails existants
 
     # Statistiques détaillées de filtrage
     stats = {
@@ -613,138 +1020,98 @@ def main():
         "invalid_comment": 0, # Commentaire suspect
     }
 
-    for i, msg_info in enumerate(new_messages):
-        try:
-            msg = api_call_with_retry(
-                gmail_service.users().messages().get(
-                    userId="me",
-                    id=msg_info["id"],
-                    format="full",
-                ).execute
-            )
+    def on_message(msg_id, msg, exception):
+        if exception is not None:
+            error_msg = f"Erreur mail ID {msg_id}: {str(exception)}"
+            print(f"   ❌ {error_msg}")
+            errors.append(error_msg)
+            # Mail supprimé entre-temps (404) : inutile de le retenter
+            if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                failed_ids.append(msg_id)
+            return
 
+        try:
             # Extraire les données
-            nom_commerce = get_sender_name(msg)
-            date_reception = get_email_date(msg)
+            headers = index_headers(msg)
+            nom_commerce = get_sender_name(headers)
+            date_reception = get_email_date(headers)
             body = get_email_body(msg)
             parsed = parse_email_body(body)
 
             # Marquer comme traité dans tous les cas
-            processed_ids.add(msg_info["id"])
-
-            # Si pas d'email trouvé (champ obligatoire), ignorer
-            if parsed is None:
-                stats["no_email"] += 1
-                continue
-
-            # Filtrer les emails invalides
-            if not is_valid_email(parsed["email"]):
-                stats["invalid_email"] += 1
-                continue
-
-            # Dédoublonnage par email
-            email_lower = parsed["email"].lower().strip()
-            if email_lower in seen_emails:
-                stats["duplicate"] += 1
-                continue
-            seen_emails.add(email_lower)
-
-            # Filtrer les noms suspects
-            if not is_valid_name(parsed["nom"], parsed["prenom"]):
-                stats["invalid_name"] += 1
-                continue
-
-            # Filtrer les commentaires suspects
-            if not is_valid_comment(parsed["commentaire"]):
-                stats["invalid_comment"] += 1
-                continue
-
-            # Colonnes : ID | Nom commerce (→ subdomain) | Catégorie | Genre | Nom | Prénom | Nom complet | Email | Statut Email | Note | Date | Commentaire
-            # Note: ID (colonne A) est généré automatiquement par =ROW(), on écrit à partir de B
-            subdomain = convert_commerce_to_subdomain(nom_commerce)
-            row = [
-                subdomain,              # B: Subdomain (converti depuis Nom commerce)
-                DEFAULT_CATEGORY,       # C: Catégorie
-                parsed["genre"],        # D: Genre
-                parsed["nom"],          # E: Nom
-                parsed["prenom"],       # F: Prénom
-                "",                     # G: Nom complet (vide)
-                parsed["email"],        # H: Email
-                "Pending",              # I: Statut Email
-                1,                      # J: Note
-                date_reception,         # K: Date de réception
-                parsed["commentaire"],  # L: Commentaire
-            ]
-            rows_to_add.append(row)
-
-            if (i + 1) % 50 == 0:
-                print(f"   ⏳ {i + 1}/{len(new_messages)} mails traités...")
+            processed_ids.add(msg_id)
+            recent_ids.append(msg_id)
+            unsaved_ids.append(msg_id)
+
+            # Filtrer et construire la ligne en une seule passe
+            row = build_row(parsed, nom_commerce, date_reception, seen_emails, stats)
+            if row is not None:
+                rows_to_add.append(row)
+                row_emails.append(parsed.email)
 
         except Exception as e:
-            error_msg = f"Erreur mail ID {msg_info['id']}: {str(e)}"
+            error_msg = f"Erreur mail ID {msg_id}: {str(e)}"
             print(f"   ❌ {error_msg}")
             errors.append(error_msg)
+            failed_ids.append(msg_id)
+
+    def save_progress(final=False):
+        """
+        Écrit le tampon de lignes puis enregistre l'état (IDs traités, emails écrits).
+        Appelé après chaque tranche : si l'exécution s'interrompt, les mails déjà
+        écrits ne sont pas re-traités (et dupliqués) à l'exécution suivante.
+        """
+        nonlocal rows_added, stored_count
+        if rows_to_add:
+            append_rows(sheets_service, rows_to_add)
+            rows_added += len(rows_to_add)
+            unsaved_emails.extend(row_emails)
+            rows_to_add.clear()
+            row_emails.clear()
+
+        state["processed_ids"] = list(recent_ids)
+        state["processed_emails"] = stored_emails + unsaved_emails
+        saved_count = save_state(
+            state, sheets_service, unsaved_ids, unsaved_emails,
+            stored_count + len(unsaved_ids), final=final,
+        )
+        if saved_count is not None:
+            # Sauvegarde réussie, sinon les ajouts sont retentés à la suivante
+            stored_count = saved_count
+            stored_emails.extend(unsaved_emails)
+            unsaved_ids.clear()
+            unsaved_emails.clear()
+
+    # Récupérer les mails par lots (une requête HTTP par lot de GMAIL_BATCH_SIZE)
+    print("📤 Extraction et écriture dans Google Sheets au fil de l'eau...")
+    # closing() : en cas d'erreur, le générateur est fermé et les lots restants annulés
+    with closing(fetch_messages(gmail_service, creds, list(new_messages))) as fetched:
+        for msg_id, msg, exception in fetched:
+            on_message(msg_id, msg, exception)
+
+            # Écrire par tranches pendant que les lots suivants se téléchargent
+            if len(rows_to_add) >= SHEET_WRITE_BATCH_SIZE:
+                save_progress()
+                print(f"   → {rows_added} lignes écrites")
+
+    # Écrire les lignes restantes et l'état final (date d'exécution, IDs en erreur)
+    state["last_run"] = datetime.now().isoformat()
+    state["failed_ids"] = failed_ids
+    save_progress(final=True)
+    print("💾 État sauvegardé.")
 
+    # Résumé construit puis affiché en une seule écriture
     total_filtered = sum(stats.values())
-    print(f"\n✅ Extraction terminée : {len(rows_to_add)} mails extraits, {total_filtered} filtrés, {len(errors)} erreurs")
+    summary = [f"\n✅ Extraction terminée : {rows_added} mails extraits, {total_filtered} filtrés, {len(errors)} erreurs"]
     if total_filtered > 0:
-        print(f"   Détail filtrage : {stats['no_email']} sans email, {stats['invalid_email']} email invalide, "
-              f"{stats['duplicate']} doublons, {stats['invalid_name']} nom suspect, {stats['invalid_comment']} commentaire suspect")
-
-    # Écrire dans Google Sheets
-    if rows_to_add:
-        print("\n📤 Écriture dans Google Sheets...")
-
-        # Trouver la prochaine ligne vide (on regarde la colonne B car A contient l'ID)
-        result = api_call_with_retry(
-            sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!B:B",
-            ).execute
-        )
-        existing_rows = len(result.get("values", []))
-        next_row = existing_rows + 1
-
-        # S'assurer que la feuille a assez de lignes
-        total_rows_needed = next_row + len(rows_to_add)
-        ensure_sheet_has_enough_rows(sheets_service, SPREADSHEET_ID, SHEET_NAME, total_rows_needed)
-
-        # Écrire par lots de 500 pour éviter les timeout
-        batch_size = 500
-        for start in range(0, len(rows_to_add), batch_size):
-            batch = rows_to_add[start:start + batch_size]
-            body = {"values": batch}
-            api_call_with_retry(
-                sheets_service.spreadsheets().values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f"{SHEET_NAME}!B{next_row + start}",  # Commence à B (A = ID auto)
-                    valueInputOption="RAW",
-                    body=body,
-                ).execute
-            )
-            print(f"   → Lot {start + 1} à {start + len(batch)} écrit")
-
-        # Ajouter la formule =ROW() pour les IDs des nouvelles lignes
-        id_formulas = [["=ROW()"] for _ in range(len(rows_to_add))]
-        api_call_with_retry(
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A{next_row}:A{next_row + len(rows_to_add) - 1}",
-                valueInputOption="USER_ENTERED",
-                body={"values": id_formulas},
-            ).execute
-        )
-
-        print(f"   ✅ {len(rows_to_add)} lignes ajoutées")
-
-    # Sauvegarder l'état
-    state["processed_ids"] = list(processed_ids)
-    state["last_run"] = datetime.now().isoformat()
-    save_state(state, sheets_service)
-    print("\n💾 État sauvegardé.")
+        summary.append(f"   Détail filtrage : {stats['no_email']} sans email, {stats['invalid_email']} email invalide, "
+                       f"{stats['duplicate']} doublons, {stats['invalid_name']} nom suspect, {stats['invalid_comment']} commentaire suspect")
+    if rows_added:
+        summary.append(f"   ✅ {rows_added} lignes ajoutées dans Google Sheets")
+    print("\n".join(summary))
 
     # Envoyer la notification
-    send_notification(gmail_service, len(rows_to_add), stats, errors)
+    send_notification(gmail_service, rows_added, stats, errors)
 
     print("\n🎉 Terminé !")
 
@@ -39,6 +39,28 @@ SPREADSHEET_ID = CONFIG.get("spreadsheet_id", "")
 SHEET_NAME = CONFIG.get("sheet_name", "Avis")
 COMMERCE_TO_SUBDOMAIN = CONFIG.get("commerce_to_subdomain", {})
 
+# Même mapping indexé par nom normalisé (minuscules, sans espaces autour) ;
+# en cas de doublon après normalisation, la première entrée l'emporte
+COMMERCE_TO_SUBDOMAIN_LOWER = {
+    commerce.lower().strip(): subdomain
+    for commerce, subdomain in reversed(COMMERCE_TO_SUBDOMAIN.items())
+}
+
+# Valeurs déjà converties : subdomains du mapping et domaines Good Reviews
+KNOWN_SUBDOMAINS = frozenset(COMMERCE_TO_SUBDOMAIN.values())
+SUBDOMAIN_SUFFIXES = (".good-reviews.ch", ".goodreviews.ch")
+
+
+def save_token(creds):
+    """Écrit le token sur disque, sauf s'il est identique au fichier existant."""
+    new_token = creds.to_json()
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, "r") as token:
+            if token.read() == new_token:
+                return
+    with open(TOKEN_FILE, "w") as token:
+        token.write(new_token)
+
 
 def get_credentials():
     """Authentification Google."""
@@ -50,8 +72,7 @@ def get_credentials():
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
-            with open(TOKEN_FILE, "w") as token:
-                token.write(creds.to_json())
+            save_token(creds)
         else:
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
@@ -71,10 +92,9 @@ def convert_commerce_to_subdomain(nom_commerce):
         return COMMERCE_TO_SUBDOMAIN[nom_commerce]
 
     # Recherche insensible à la casse
-    nom_lower = nom_commerce.lower().strip()
-    for commerce, subdomain in COMMERCE_TO_SUBDOMAIN.items():
-        if commerce.lower().strip() == nom_lower:
-            return subdomain
+    subdomain = COMMERCE_TO_SUBDOMAIN_LOWER.get(nom_commerce.lower().strip())
+    if subdomain is not None:
+        return subdomain
 
     # Pas de correspondance trouvée
     return nom_commerce
@@ -105,28 +125,24 @@ def main():
         print("\n Aucune donnee a mettre a jour.")
         return
 
-    # Preparer les nouvelles valeurs (garder l'en-tete)
-    updated_values = [values[0]]  # En-tete
-    converted_count = 0
+    # Preparer uniquement les cellules modifiees (numero de ligne, nouvelle valeur)
+    changes = []
     not_found = set()
 
     for i, row in enumerate(values[1:], start=2):
         if not row:
-            updated_values.append([""])
             continue
 
         original = row[0]
         converted = convert_commerce_to_subdomain(original)
 
         if converted != original:
-            converted_count += 1
-        elif original and original not in COMMERCE_TO_SUBDOMAIN.values():
+            changes.append((i, converted))
+        elif original and original not in KNOWN_SUBDOMAINS and not original.endswith(SUBDOMAIN_SUFFIXES):
             # Nom pas dans le mapping et pas deja un subdomain
-            if not original.endswith(".good-reviews.ch") and not original.endswith(".goodreviews.ch"):
-                not_found.add(original)
-
-        updated_values.append([converted])
+            not_found.add(original)
 
+    converted_count = len(changes)
     print(f"\n   {converted_count} valeurs a convertir")
     print(f"   {len(not_found)} valeurs non trouvees dans le mapping")
 
@@ -143,11 +159,15 @@ def main():
 
     # Ecrire les nouvelles valeurs
     print(f"\nEcriture des {converted_count} conversions...")
-    sheets_service.spreadsheets().values().update(
+    sheets_service.spreadsheets().values().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{SHEET_NAME}!B1:B{len(updated_values)}",
-        valueInputOption="RAW",
-        body={"values": updated_values},
+        body={
+            "valueInputOption": "RAW",
+            "data": [
+                {"range": f"{SHEET_NAME}!B{i}", "values": [[converted]]}
+                for i, converted in changes
+            ],
+        },
     ).execute()
 
     print(f"   {converted_count} lignes mises a jour !")